@@ -1,17 +1,27 @@
 #!/usr/bin/python3
 
+import shlex
 import docopt
 import logging
 import pyparsing
 
 from .Expressions import parseExpression, evaluateExpression
+from .Functions import FunctionReturn
+from .Variables import formatSize
 
 class Command:
     usage=''
     split=True
+    # Streaming commands implement pipe and can be chained with |
+    streaming=False
     logger=logging.getLogger('Shell')
+    # A dict of words, or a method that gets the word being completed and
+    # returns the words starting with it
     word_completer=None
     file_completer=None
+    # Seconds and number of words the results of a method are cached for
+    completion_ttl=30
+    completion_cache=128
 
     def __init__(self, shell):
         self.shell = shell
@@ -32,8 +42,34 @@ class Command:
             exit(3)
 
     def action(self):
+        # Streaming commands print their records when run on their own
+        if self.streaming:
+            for record in self.pipe(None):
+                print(record)
+            return
+        raise NotImplementedError()
+
+    def pipe(self, records):
+        # Receives an iterator over the records of the previous stage, or
+        # None if this is the first stage, and yields records lazily
         raise NotImplementedError()
 
+    def invalidateCompletions(self):
+        # Forget the cached results of word_completer, for when what they
+        # are computed from changed
+        for name, command in self.shell.commands.items():
+            if command is self:
+                self.shell.completer.invalidate(name)
+
+    def runPrograms(self, commands, jobs=1):
+        # Run external programs, each one a list of arguments, through the
+        # shell's process pool. Their output is printed line by line and
+        # their exit codes are returned.
+        return self.shell.processes.run(commands, print, jobs)
+
+    def runProgram(self, command):
+        return self.runPrograms([command])[0]
+
 # Service Commands
 class Exit(Command):
     usage='''
@@ -50,7 +86,7 @@ class Exit(Command):
         exit(0)
 
 class Help(Command):
-    word_completer = {'commands': None, 'variables': None, 'all': None}
+    word_completer = {'commands': None, 'variables': None, 'memory': None, 'all': None}
     usage='''
     help
 
@@ -58,6 +94,7 @@ class Help(Command):
         help -h
         help commands
         help variables
+        help memory
         help all
 
     Options:
@@ -80,10 +117,19 @@ class Help(Command):
             for variable in self.shell.variables:
                 print('\t- ' + variable)
             print('Run `echo $var-name` to get the value of the variable.')
+        if self.args['memory'] or self.args['all']:
+            report, budget = self.shell.memoryReport()
+            print('Variables memory: ')
+            for name, size, spilled in report:
+                print('\t- {}: {}{}'.format(name, formatSize(size), ' (on disk)' if spilled else ''))
+            memory = sum(size for name, size, spilled in report if not spilled)
+            budget = 'no limit' if budget is None else formatSize(budget)
+            print('In memory: {} of {}, on disk: {} variables.'.format(formatSize(memory), budget, sum(1 for row in report if row[2])))
 
 # Reading/Writing Variables
 class Echo(Command):
     split=False
+    streaming=True
     usage='''
     echo
 
@@ -95,7 +141,8 @@ class Echo(Command):
         -h, --help                              Print this help message
     '''
 
-    def action(self):
+    def pipe(self, records):
+        # Like any shell echo, input records are ignored
         if self.args is None:
             # Used the help flag
             return
@@ -104,8 +151,8 @@ class Echo(Command):
             return
         try:
             ast = parseExpression(self.args['EXPR'])
-            value = evaluateExpression(ast, self.shell.builtin_variables, self.shell.variables)
-            print(value)
+            value = evaluateExpression(ast, self.shell.builtin_variables, self.shell.variables, self.shell.callFunction)
+            yield value
         except NameError as e:
             # Already handled inside parseExpression
             pass
@@ -141,8 +188,7 @@ class Unset(Command):
             if self.args['NAME'][1:] not in self.shell.variables:
                 self.logger.error('Variable does not exist.')
                 return
-            del self.shell.variables[self.args['NAME'][1:]]
-            self.shell.completer.deleteVariable(self.args['NAME'][1:])
+            self.shell.unsetVariable(self.args['NAME'][1:])
         elif self.args['NAME'][0] == '$' and self.args['NAME'][1] == '{':
             if self.args['NAME'][-1] != '}':
                 self.logger.error('Unbalanced curly brackets.')
@@ -153,8 +199,7 @@ class Unset(Command):
             if self.args['NAME'][2:-1] not in self.shell.variables:
                 self.logger.error('Variable does not exist.')
                 return
-            del self.shell.variables[self.args['NAME'][2:-1]]
-            self.shell.completer.deleteVariable(self.args['NAME'][2:-1])
+            self.shell.unsetVariable(self.args['NAME'][2:-1])
 
 class Set(Command):
     split=False
@@ -185,13 +230,9 @@ class Set(Command):
             return
         try:
             ast = parseExpression(splits[1])
-            value = evaluateExpression(ast, self.shell.builtin_variables, self.shell.variables)
+            value = evaluateExpression(ast, self.shell.builtin_variables, self.shell.variables, self.shell.callFunction)
             name = splits[0].replace(' ', '')
-            if name in self.shell.builtin_variables:
-                self.shell.builtin_variables[name] = value
-            else:
-                self.shell.variables[name] = value
-                self.shell.completer.addVariable(name)
+            self.shell.setVariable(name, value)
         except NameError as e:
             # Already handled inside parseExpression
             pass
@@ -220,3 +261,186 @@ class Source(Command):
             self.logger.error('Must specify a file to source.')
             return
         self.shell.runScript(self.args['FILE'], shell_after=False)
+
+class Return(Command):
+    split=False
+    usage='''
+    return
+
+    Usage:
+        return -h
+        return [EXPR]
+
+    Options:
+        -h, --help                              Print this help message
+    '''
+
+    def action(self):
+        if self.args is None:
+            # Used the help flag
+            return
+        if not self.shell.frames:
+            self.logger.error('Cannot return from outside of a function.')
+            return
+        value = None
+        if self.args['EXPR'] is not None and self.args['EXPR'].strip() != '':
+            try:
+                ast = parseExpression(self.args['EXPR'])
+                value = evaluateExpression(ast, self.shell.builtin_variables, self.shell.variables, self.shell.callFunction)
+            except pyparsing.ParseException as e:
+                self.logger.error('Couldn\'t parse expression {}.', self.args['EXPR'])
+                raise NameError('Invalid return value')
+            # A NameError, already logged, goes up to the expression that
+            # called the function, which is skipped like for any undefined
+            # variable
+        raise FunctionReturn(value)
+
+class Import(Command):
+    file_completer = ['json', 'csv', 'env']
+    usage='''
+    import
+
+    Usage:
+        import -h
+        import [--format=FORMAT] FILE
+
+    Options:
+        -h, --help                              Print this help message
+        -f FORMAT, --format=FORMAT              One of json, csv or env, guessed from the extension otherwise
+    '''
+
+    def action(self):
+        if self.args is None:
+            # Used the help flag
+            return
+        if self.args['FILE'] is None:
+            self.logger.error('Must specify a file to import.')
+            return
+        self.shell.loadVariables(self.args['FILE'], self.args['--format'])
+
+# External Programs
+class Run(Command):
+    usage='''
+    run
+
+    Usage:
+        run -h
+        run [-j N] PROGRAM [ARGS...]
+
+    Options:
+        -h, --help                              Print this help message
+        -j N, --jobs=N                          How many programs to run at the same time [default: 1]
+
+    Arguments after ::: are run one program each, replacing {} in the
+    arguments before ::: or appended to them if there is no {}. The exit
+    code is saved in $status, or the first failing one when running many.
+    '''
+
+    def getArgs(self, command):
+        # Arguments are split like a shell does, and everything from the
+        # program on belongs to it
+        self.args = None
+        try:
+            self.args = docopt.docopt(self.usage, argv=shlex.split(command), options_first=True)
+        except ValueError as e:
+            self.logger.error('Couldn\'t split arguments {}. Caused by:\n\t{}', command, e)
+        except docopt.DocoptExit:
+            pass
+        except SystemExit:
+            pass
+
+    def action(self):
+        if self.args is None:
+            # Used the help flag
+            return
+        try:
+            jobs = int(self.args['--jobs'])
+        except ValueError:
+            jobs = 0
+        if jobs < 1:
+            self.logger.error('Number of jobs must be a positive integer.')
+            return
+        command = [self.args['PROGRAM']] + self.args['ARGS']
+        if ':::' in command:
+            split = command.index(':::')
+            template = command[:split]
+            commands = []
+            replace = any('{}' in part for part in template)
+            for argument in command[split+1:]:
+                if replace:
+                    commands.append([part.replace('{}', argument) for part in template])
+                else:
+                    commands.append(template + [argument])
+        else:
+            commands = [command]
+        statuses = self.runPrograms(commands, jobs)
+        self.shell.setVariable('status', next((status for status in statuses if status != 0), 0))
+
+class Compile(Command):
+    file_completer = ['sh', 'shell', 'script']
+    usage='''
+    compile
+
+    Usage:
+        compile -h
+        compile SCRIPT OUTPUT
+
+    Options:
+        -h, --help                              Print this help message
+
+    Translates SCRIPT into the python module OUTPUT, its run(shell)
+    function does what sourcing SCRIPT would, with the commands of this
+    shell.
+    '''
+
+    def action(self):
+        if self.args is None:
+            # Used the help flag
+            return
+        self.shell.compileScript(self.args['SCRIPT'], self.args['OUTPUT'])
+
+# Snapshots
+class Save(Command):
+    split=False
+    usage='''
+    save
+
+    Usage:
+        save -h
+        save FILE
+
+    Options:
+        -h, --help                              Print this help message
+    '''
+
+    def action(self):
+        if self.args is None:
+            # Used the help flag
+            return
+        if self.args['FILE'] is None:
+            self.logger.error('Must specify a file to save to.')
+            return
+        self.shell.saveState(self.args['FILE'])
+
+class Load(Command):
+    file_completer = ['snapshot']
+    split=False
+    usage='''
+    load
+
+    Usage:
+        load -h
+        load FILE
+
+    Options:
+        -h, --help                              Print this help message
+    '''
+
+    def action(self):
+        if self.args is None:
+            # Used the help flag
+            return
+        if self.args['FILE'] is None:
+            self.logger.error('Must specify a file to load.')
+            return
+        self.shell.loadState(self.args['FILE'])
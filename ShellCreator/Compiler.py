@@ -0,0 +1,205 @@
+#!/usr/bin/python3
+
+import io
+import logging
+import pyparsing
+from contextlib import redirect_stdout
+
+from .Expressions import Literal, Var, Interpolated, Unary, BinaryChain, Call, parseExpression, splitArguments
+from .Utils.VariableFiles import valid_name
+
+logger = logging.getLogger('Shell')
+
+# Used by the generated modules at runtime
+def lookup(shell, name):
+    if name in shell.builtin_variables:
+        return shell.builtin_variables[name]
+    elif name in shell.variables:
+        return shell.variables[name]
+    logger.error('Variable {} does not exist.', name)
+    raise NameError('Variable does not exist')
+
+class ScriptCompiler:
+    # Translates a script into a python module with a run(shell) function.
+    # set, echo and the conditions of if, while and for are turned into
+    # python code, other commands get their arguments parsed ahead of time.
+    # Whatever cannot be translated exactly is left to the interpreter.
+    def __init__(self, shell):
+        self.shell = shell
+        self.code = []
+        self.constants = []
+        self.counter = 0
+
+    def emit(self, indent, line):
+        self.code.append('    ' * indent + line)
+
+    def newName(self, prefix):
+        self.counter += 1
+        return '{}_{}'.format(prefix, self.counter)
+
+    def compileScript(self, lines, source='script'):
+        statements = self.shell.compileBlock(lines)
+        self.compileStatements(statements, 1)
+        header = [
+            '#!/usr/bin/python3',
+            '# Compiled from {} by ShellCreator, do not edit.'.format(source),
+            '',
+            'from ShellCreator.Compiler import lookup',
+            'from ShellCreator.Utils.Operators import operator_and, operator_or',
+            ''
+        ]
+        for i, constant in enumerate(self.constants):
+            header.append('ARGS_{} = {}'.format(i, constant))
+        header += ['', 'def run(shell):']
+        return '\n'.join(header + self.code) + '\n'
+
+    def compileStatements(self, statements, indent):
+        if not statements:
+            self.emit(indent, 'pass')
+        for statement in statements:
+            if isinstance(statement, str):
+                self.compileCommand(statement, indent)
+            else:
+                self.compileControl(statement, indent)
+
+    def fallback(self, statement, indent):
+        if isinstance(statement, str):
+            self.emit(indent, 'shell.runCommand({!r})'.format(statement))
+        else:
+            self.emit(indent, 'shell.runControl(*{!r})'.format(statement))
+
+    def compileExpression(self, node):
+        if isinstance(node, Literal):
+            return repr(node.value)
+        elif isinstance(node, Var):
+            return 'lookup(shell, {!r})'.format(node.name)
+        elif isinstance(node, Interpolated):
+            parts = []
+            for part in node.parts:
+                if isinstance(part, str):
+                    parts.append(repr(part))
+                else:
+                    parts.append('str({})'.format(self.compileExpression(part)))
+            return '\'\'.join([{}])'.format(', '.join(parts))
+        elif isinstance(node, Unary):
+            return '({} {})'.format(node.operator, self.compileExpression(node.operand))
+        elif isinstance(node, BinaryChain):
+            operands = [self.compileExpression(operand) for operand in node.operands]
+            if node.operators[0] == '**':
+                code = operands[-1]
+                for i in range(len(node.operators) - 1, -1, -1):
+                    code = '({} ** {})'.format(operands[i], code)
+                return code
+            code = operands[0]
+            for symbol, operand in zip(node.operators, operands[1:]):
+                # and/or evaluate both sides in the interpreter
+                if symbol == 'and' or symbol == 'or':
+                    code = 'operator_{}({}, {})'.format(symbol, code, operand)
+                else:
+                    code = '({} {} {})'.format(code, symbol, operand)
+            return code
+        elif isinstance(node, Call):
+            arguments = ', '.join(self.compileExpression(argument) for argument in node.arguments)
+            return 'shell.callFunction({!r}, [{}])'.format(node.name, arguments)
+        raise TypeError('Unknown node {}'.format(node))
+
+    def parse(self, text):
+        # Returns the python code of an expression, or None if the
+        # interpreter has to deal with it
+        try:
+            return self.compileExpression(parseExpression(text))
+        except pyparsing.ParseException:
+            return None
+
+    def compileCommand(self, line, indent):
+        split = line.split(' ', 1)
+        command = split[0]
+        rest = split[1] if len(split) == 2 else ''
+        if command not in self.shell.commands or len(splitArguments(line, '|')) > 1:
+            # Functions, pipelines and unknown commands
+            self.fallback(line, indent)
+        elif command == 'set':
+            splits = rest.split('=')
+            name = splits[0].replace(' ', '')
+            code = self.parse(splits[1]) if len(splits) == 2 and splits[1] != '' else None
+            if code is None or not valid_name.match(name):
+                self.fallback(line, indent)
+                return
+            self.emit(indent, 'try:')
+            self.emit(indent + 1, 'shell.setVariable({!r}, {})'.format(name, code))
+            self.emit(indent, 'except NameError:')
+            self.emit(indent + 1, 'pass')
+        elif command == 'echo':
+            # docopt takes anything starting with - as an option, echo -5
+            # prints nothing in the interpreter
+            code = self.parse(rest) if rest.strip() != '' and not rest.lstrip().startswith('-') else None
+            if code is None:
+                self.fallback(line, indent)
+                return
+            self.emit(indent, 'try:')
+            self.emit(indent + 1, 'print({})'.format(code))
+            self.emit(indent, 'except NameError:')
+            self.emit(indent + 1, 'pass')
+        else:
+            # Parse the arguments now, help is printed by docopt so it is
+            # left for the interpreter
+            instance = type(self.shell.commands[command])(self.shell)
+            with redirect_stdout(io.StringIO()):
+                instance.getArgs(rest)
+            if instance.args is None:
+                self.fallback(line, indent)
+                return
+            self.constants.append(repr(instance.args))
+            command_name = self.newName('command')
+            self.emit(indent, '{} = shell.commands[{!r}]'.format(command_name, command))
+            self.emit(indent, '{}.args = dict(ARGS_{})'.format(command_name, len(self.constants) - 1))
+            self.emit(indent, '{}.action()'.format(command_name))
+
+    def compileControl(self, statement, indent):
+        control_type, conditions, commands = statement
+        if control_type == 'if':
+            codes = []
+            for i, condition in enumerate(conditions):
+                if condition is None:
+                    # Only an else at the end behaves like one
+                    code = 'True' if i == len(conditions) - 1 else None
+                else:
+                    code = self.parse(condition)
+                if code is None:
+                    self.fallback(statement, indent)
+                    return
+                codes.append(code)
+            branch = self.newName('branch')
+            self.emit(indent, '{} = None'.format(branch))
+            self.emit(indent, 'try:')
+            for i, code in enumerate(codes):
+                self.emit(indent + 1, '{} {}:'.format('if' if i == 0 else 'elif', code))
+                self.emit(indent + 2, '{} = {}'.format(branch, i))
+            self.emit(indent, 'except NameError:')
+            self.emit(indent + 1, 'pass')
+            for i, body in enumerate(commands):
+                self.emit(indent, '{} {} == {}:'.format('if' if i == 0 else 'elif', branch, i))
+                self.compileStatements(body, indent + 1)
+        elif control_type == 'while' and len(conditions) == 1:
+            code = self.parse(conditions[0])
+            if code is None:
+                self.fallback(statement, indent)
+                return
+            self.emit(indent, 'while True:')
+            self.emit(indent + 1, 'try:')
+            self.emit(indent + 2, 'if not {}:'.format(code))
+            self.emit(indent + 3, 'break')
+            self.emit(indent + 1, 'except NameError:')
+            self.emit(indent + 2, 'break')
+            self.compileStatements(commands[0], indent + 1)
+        elif control_type == 'for' and len(conditions) == 1:
+            name = self.newName('name')
+            values = self.newName('values')
+            value = self.newName('value')
+            self.emit(indent, '{}, {} = shell.loopValues({!r})'.format(name, values, conditions[0]))
+            self.emit(indent, 'for {} in {}:'.format(value, values))
+            self.emit(indent + 1, 'shell.setVariable({}, {})'.format(name, value))
+            self.compileStatements(commands[0], indent + 1)
+        else:
+            # Functions and parallel blocks
+            self.fallback(statement, indent)
@@ -1,16 +1,222 @@
 #!/usr/bin/python3
 
 import os
+import time
+import logging
+import threading
+import collections
+import concurrent.futures
 from prompt_toolkit.application import get_app
 from prompt_toolkit.document import Document
-from prompt_toolkit.completion import WordCompleter, NestedCompleter, PathCompleter, DynamicCompleter
+from prompt_toolkit.completion import Completer as BaseCompleter, Completion, WordCompleter, NestedCompleter, DynamicCompleter
+
+logger = logging.getLogger('Shell')
+
+class DirectoryScan:
+    # Entries of a directory as a background scan finds them
+    def __init__(self):
+        self.entries = []
+        self.done = False
+        self.condition = threading.Condition()
+
+class FileCompleter(BaseCompleter):
+    # Completes directories and files with one of the given extensions.
+    # Listings are cached per directory, a cached listing is used as is
+    # for ttl seconds and after that only while the directory's mtime
+    # did not change.
+    max_directories = 64
+    # Entries found before waking up the completions waiting on a scan
+    batch = 64
+
+    def __init__(self, extensions, ttl=2):
+        self.extensions = set(extensions)
+        self.ttl = ttl
+        self.cache = {}
+        self.scanning = {}
+        self.lock = threading.Lock()
+
+    def matches(self, name):
+        return '.' in name and name.rpartition('.')[2] in self.extensions
+
+    def listDirectory(self, directory):
+        with self.lock:
+            cached = self.cache.get(directory)
+            if cached is not None:
+                checked, mtime, entries = cached
+                now = time.monotonic()
+                if now - checked < self.ttl:
+                    return entries
+                try:
+                    if os.stat(directory).st_mtime_ns == mtime:
+                        self.cache[directory] = (now, mtime, entries)
+                        return entries
+                except OSError:
+                    del self.cache[directory]
+                    return []
+                del self.cache[directory]
+        return self.readScan(self.startScan(directory))
+
+    def startScan(self, directory):
+        # Scans run on their own thread and always finish into the cache,
+        # even when the completion that started them is dropped because
+        # another key was typed. Later completions wait on the same scan.
+        with self.lock:
+            scan = self.scanning.get(directory)
+            if scan is None:
+                scan = DirectoryScan()
+                self.scanning[directory] = scan
+                threading.Thread(target=self.scanDirectory, args=(directory, scan), daemon=True).start()
+        return scan
+
+    def scanDirectory(self, directory, scan):
+        # scandir knows the entry types without an extra stat per entry
+        mtime = None
+        try:
+            checked = time.monotonic()
+            mtime = os.stat(directory).st_mtime_ns
+            with os.scandir(directory) as iterator:
+                for entry in iterator:
+                    try:
+                        is_dir = entry.is_dir()
+                    except OSError:
+                        is_dir = False
+                    if is_dir or self.matches(entry.name):
+                        with scan.condition:
+                            scan.entries.append((entry.name, is_dir))
+                            if len(scan.entries) % self.batch == 0:
+                                scan.condition.notify_all()
+        except OSError:
+            mtime = None
+        finally:
+            with self.lock:
+                # Sorted once for the cache, only completions shown while
+                # the scan runs are in the order scandir found them
+                if mtime is not None:
+                    if len(self.cache) >= self.max_directories:
+                        del self.cache[next(iter(self.cache))]
+                    self.cache[directory] = (checked, mtime, sorted(scan.entries))
+                del self.scanning[directory]
+            with scan.condition:
+                scan.done = True
+                scan.condition.notify_all()
+
+    def readScan(self, scan):
+        # Yield entries while the scan runs, so huge directories start
+        # showing completions right away
+        position = 0
+        while True:
+            with scan.condition:
+                while position >= len(scan.entries) and not scan.done:
+                    scan.condition.wait()
+                entries = scan.entries[position:]
+                if scan.done and position == 0:
+                    # Finished before anything was shown, like the cache
+                    entries.sort()
+            if not entries:
+                return
+            position += len(entries)
+            yield from entries
+
+    def get_completions(self, document, complete_event):
+        text = os.path.expanduser(document.text_before_cursor)
+        directory, prefix = os.path.split(text)
+        for name, is_dir in self.listDirectory(directory or '.'):
+            if name.startswith(prefix):
+                yield Completion(name[len(prefix):], 0, display=name + '/' if is_dir else name)
+
+class ProviderCompleter(BaseCompleter):
+    # Completes words with a command's provider, a callable that gets the
+    # word being completed and returns the words starting with it. Results
+    # are cached per word for ttl seconds, keeping the max_prefixes most
+    # recently used, and the result of a shorter word is filtered instead
+    # of calling the provider again. Providers run on a shared pool so a
+    # word that is already being computed is waited on, not computed again.
+    executor = None
+    executor_pid = None
+    max_workers = 4
+
+    def __init__(self, provider, ttl=30, max_prefixes=128):
+        self.provider = provider
+        self.ttl = ttl
+        self.max_prefixes = max_prefixes
+        self.cache = collections.OrderedDict()
+        self.pending = {}
+        # Bumped on invalidation, so results computed before are dropped
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    @classmethod
+    def getExecutor(cls):
+        # Like the process pool, a forked child needs threads of its own
+        if cls.executor is None or cls.executor_pid != os.getpid():
+            cls.executor = concurrent.futures.ThreadPoolExecutor(max_workers=cls.max_workers)
+            cls.executor_pid = os.getpid()
+        return cls.executor
+
+    def invalidate(self):
+        with self.lock:
+            self.cache.clear()
+            self.pending.clear()
+            self.generation += 1
+
+    def cached(self, prefix):
+        # Words for prefix from the cache, None if nothing fresh is there
+        now = time.monotonic()
+        for length in range(len(prefix), -1, -1):
+            entry = self.cache.get(prefix[:length])
+            if entry is None:
+                continue
+            computed, words = entry
+            if now - computed >= self.ttl:
+                del self.cache[prefix[:length]]
+                continue
+            self.cache.move_to_end(prefix[:length])
+            if length == len(prefix):
+                return words
+            return [word for word in words if word.startswith(prefix)]
+        return None
+
+    def compute(self, prefix, generation):
+        try:
+            words = [str(word) for word in self.provider(prefix)]
+        except Exception as e:
+            logger.error('Completion provider failed. Caused by:\n\t{}', e)
+            words = None
+        with self.lock:
+            if generation == self.generation:
+                if words is not None:
+                    self.cache[prefix] = (time.monotonic(), words)
+                    while len(self.cache) > self.max_prefixes:
+                        self.cache.popitem(last=False)
+                del self.pending[prefix]
+        return words or []
+
+    def getWords(self, prefix):
+        with self.lock:
+            words = self.cached(prefix)
+            if words is not None:
+                return words
+            future = self.pending.get(prefix)
+            if future is None:
+                future = self.getExecutor().submit(self.compute, prefix, self.generation)
+                self.pending[prefix] = future
+        # Completions run in their own thread, waiting here does not block
+        # the prompt
+        return future.result()
+
+    def get_completions(self, document, complete_event):
+        prefix = document.get_word_before_cursor(WORD=True)
+        for word in self.getWords(prefix):
+            if word.startswith(prefix):
+                yield Completion(word, -len(prefix))
 
 class Completer():
 
     def __init__(self):
         self.variables = []
         self.quoted_variables = []
-        self.nested_dict = {}
+        # Control keywords are completed like commands
+        self.nested_dict = {'if': None, 'elif': None, 'else': None, 'while': None, 'for': None, 'function': None, 'parallel': None, 'end': None}
 
     def getCompleter(self):
         # document = get_app().current_buffer.document
@@ -38,6 +244,22 @@ class Completer():
         self.variables.append('$' + name)
         self.quoted_variables.append('${' + name + '}')
 
+    def addVariables(self, names):
+        # Add many variables at once, names already in the index are skipped
+        existing = set(self.variables)
+        names = [name for name in names if ('$' + name) not in existing]
+        self.variables.extend(['$' + name for name in names])
+        self.quoted_variables.extend(['${' + name + '}' for name in names])
+
+    def setVariables(self, names):
+        # Replace the whole variable index at once, used when restoring
+        # a snapshot. Names are assumed to be unique.
+        self.variables[:] = ['$' + name for name in names]
+        self.quoted_variables[:] = ['${' + name + '}' for name in names]
+
+    def getVariables(self):
+        return [variable[1:] for variable in self.variables]
+
     def deleteVariable(self, name):
         if ('$' + name) not in self.variables:
             logger.critical('Name {} already does not exist in variable autocompletion.', name)
@@ -48,22 +270,24 @@ class Completer():
         self.variables.remove('$' + name)
         self.quoted_variables.remove('${' + name + '}')
 
-    def addCommand(self, name, cls):
-        if cls.word_completer and cls.file_completer:
+    def addFunction(self, name):
+        # Functions take expressions, so nothing to complete after the name
+        self.nested_dict[name] = None
+
+    def addCommand(self, name, command):
+        if command.word_completer and command.file_completer:
             logger.critical('A command can have either a word autocompleter or a file autocompleter. Not both.')
             exit(15)
-        elif cls.word_completer:
-            self.nested_dict[name] = cls.word_completer
-        elif cls.file_completer:
-            extensions = cls.file_completer
-            # Filter Filename Function
-            def fileFilter(filename, extensions=extensions):
-                for extension in extensions:
-                    if filename.endswith('.' + extension):
-                        return True
-                    elif os.path.isdir(filename):
-                        return True
-                return False
-            self.nested_dict[name] = PathCompleter(file_filter=fileFilter)
+        elif callable(command.word_completer):
+            self.nested_dict[name] = ProviderCompleter(command.word_completer, command.completion_ttl, command.completion_cache)
+        elif command.word_completer:
+            self.nested_dict[name] = command.word_completer
+        elif command.file_completer:
+            self.nested_dict[name] = FileCompleter(command.file_completer)
         else:
             self.nested_dict[name] = None
+
+    def invalidate(self, name):
+        completer = self.nested_dict.get(name)
+        if isinstance(completer, ProviderCompleter):
+            completer.invalidate()
@@ -1,30 +1,16 @@
 #!/usr/bin/python3
 
+import re
 import pyparsing
 import logging
 import operator
+import functools
+import threading
 
 from .Utils.Operators import operator_and, operator_or
 
 logger = logging.getLogger('Shell')
 
-variable_name = pyparsing.Combine(pyparsing.Literal('$') + pyparsing.Word(pyparsing.alphas, pyparsing.alphanums + '_'))
-variable_name2 = pyparsing.Combine(pyparsing.Literal('${') + pyparsing.Word(pyparsing.alphas, pyparsing.alphanums + '_') + pyparsing.Literal('}'))
-integer = pyparsing.pyparsing_common.signed_integer
-double = pyparsing.pyparsing_common.real
-true = pyparsing.Keyword('True')
-false = pyparsing.Keyword('False')
-string = pyparsing.QuotedString('\'', escChar='\\', unquoteResults=False) | pyparsing.QuotedString('\"', escChar='\\', unquoteResults=False)
-parser = pyparsing.operatorPrecedence(variable_name | variable_name2 | double | integer | string | 
-                                true | false, [
-                                ('**', 2, pyparsing.opAssoc.RIGHT),
-                                ('-', 1, pyparsing.opAssoc.RIGHT),
-                                (pyparsing.oneOf('* / // %'), 2, pyparsing.opAssoc.LEFT),
-                                (pyparsing.oneOf('+ -'), 2, pyparsing.opAssoc.LEFT),
-                                (pyparsing.oneOf('> >= < <= == !='), 2, pyparsing.opAssoc.LEFT),
-                                ('not', 1, pyparsing.opAssoc.RIGHT),
-                                ('and', 2, pyparsing.opAssoc.LEFT),
-                                ('or', 2, pyparsing.opAssoc.LEFT)])
 unary_operators = {
     '-': operator.neg,
     'not': operator.not_,
@@ -49,91 +35,223 @@ left_binary_operators = {
     'or': operator_or,
 }
 
+# The parser builds its ASTs out of the following nodes. They are never
+# modified after parsing, so a parsed expression can be cached and shared.
+class Node:
+    __slots__ = ()
+
+    def evaluate(self, builtin_variables, variables, functions):
+        raise NotImplementedError()
+
+class Literal(Node):
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def evaluate(self, builtin_variables, variables, functions):
+        return self.value
+
+    def __repr__(self):
+        return 'Literal({!r})'.format(self.value)
+
+class Var(Node):
+    __slots__ = ('name',)
+
+    def __init__(self, name):
+        self.name = name
+
+    def evaluate(self, builtin_variables, variables, functions):
+        if self.name in builtin_variables:
+            return builtin_variables[self.name]
+        elif self.name in variables:
+            return variables[self.name]
+        logger.error('Variable {} does not exist.', self.name)
+        raise NameError('Variable does not exist')
+
+    def __repr__(self):
+        return 'Var({})'.format(self.name)
+
+class Interpolated(Node):
+    # A string with variables in it, parts are strings and Var nodes
+    __slots__ = ('parts',)
+
+    def __init__(self, parts):
+        self.parts = parts
+
+    def evaluate(self, builtin_variables, variables, functions):
+        value = ''
+        for part in self.parts:
+            if isinstance(part, str):
+                value += part
+            else:
+                value += str(part.evaluate(builtin_variables, variables, functions))
+        return value
+
+    def __repr__(self):
+        return 'Interpolated({!r})'.format(self.parts)
+
+class Unary(Node):
+    __slots__ = ('operator', 'operand')
+
+    def __init__(self, operator, operand):
+        self.operator = operator
+        self.operand = operand
+
+    def evaluate(self, builtin_variables, variables, functions):
+        return unary_operators[self.operator](self.operand.evaluate(builtin_variables, variables, functions))
+
+    def __repr__(self):
+        return 'Unary({}, {!r})'.format(self.operator, self.operand)
+
+class BinaryChain(Node):
+    # operands[0] operators[0] operands[1] operators[1] ... evaluated from
+    # the left, or from the right for right associative operators
+    __slots__ = ('operands', 'operators')
+
+    def __init__(self, operands, operators):
+        self.operands = operands
+        self.operators = operators
+
+    def evaluate(self, builtin_variables, variables, functions):
+        if self.operators[0] in right_binary_operators:
+            value = self.operands[-1].evaluate(builtin_variables, variables, functions)
+            for i in range(len(self.operators) - 1, -1, -1):
+                tmp_value = self.operands[i].evaluate(builtin_variables, variables, functions)
+                value = right_binary_operators[self.operators[i]](tmp_value, value)
+            return value
+        value = self.operands[0].evaluate(builtin_variables, variables, functions)
+        for i, symbol in enumerate(self.operators):
+            tmp_value = self.operands[i+1].evaluate(builtin_variables, variables, functions)
+            value = left_binary_operators[symbol](value, tmp_value)
+        return value
+
+    def __repr__(self):
+        return 'BinaryChain({!r}, {!r})'.format(self.operands, self.operators)
+
+class Call(Node):
+    __slots__ = ('name', 'arguments')
+
+    def __init__(self, name, arguments):
+        self.name = name
+        self.arguments = arguments
+
+    def evaluate(self, builtin_variables, variables, functions):
+        # functions is a callable taking the name and the values
+        values = [argument.evaluate(builtin_variables, variables, functions) for argument in self.arguments]
+        if functions is None:
+            logger.error('Function {} does not exist.', self.name)
+            raise NameError('Function does not exist')
+        return functions(self.name, values)
+
+    def __repr__(self):
+        return 'Call({}, {!r})'.format(self.name, self.arguments)
+
+# Variables inside strings, unless the $ is escaped
+interpolated_variable = re.compile(r'(?<!\\)\$(?:\{([a-zA-Z][a-zA-Z0-9_]*)\}|([a-zA-Z][a-zA-Z0-9_]*))')
+
+def makeString(text):
+    # Split a quoted string into its text and variables once, at parse time
+    value = text[1:-1]
+    parts = []
+    position = 0
+    for match in interpolated_variable.finditer(value):
+        if match.start() > position:
+            parts.append(value[position:match.start()])
+        parts.append(Var(match.group(1) or match.group(2)))
+        position = match.end()
+    if position == 0:
+        return Literal(value)
+    if position < len(value):
+        parts.append(value[position:])
+    return Interpolated(tuple(parts))
+
+# Parse actions take all three arguments, pyparsing guesses the arity of
+# shorter ones by calling them, which breaks when threads parse at once.
+# Parsing itself is not meant to run on many threads either.
+parse_lock = threading.Lock()
+
+def makeUnary(string, location, tokens):
+    tokens = tokens[0]
+    return Unary(tokens[0], tokens[1])
+
+def makeBinaryChain(string, location, tokens):
+    tokens = tokens[0]
+    return BinaryChain(tuple(tokens[0::2]), tuple(tokens[1::2]))
+
+variable_name = pyparsing.Combine(pyparsing.Literal('$') + pyparsing.Word(pyparsing.alphas, pyparsing.alphanums + '_'))
+variable_name.setParseAction(lambda string, location, tokens: Var(tokens[0][1:]))
+variable_name2 = pyparsing.Combine(pyparsing.Literal('${') + pyparsing.Word(pyparsing.alphas, pyparsing.alphanums + '_') + pyparsing.Literal('}'))
+variable_name2.setParseAction(lambda string, location, tokens: Var(tokens[0][2:-1]))
+integer = pyparsing.pyparsing_common.signed_integer.copy().addParseAction(lambda string, location, tokens: Literal(tokens[0]))
+double = pyparsing.pyparsing_common.real.copy().addParseAction(lambda string, location, tokens: Literal(tokens[0]))
+true = pyparsing.Keyword('True').setParseAction(lambda string, location, tokens: Literal(True))
+false = pyparsing.Keyword('False').setParseAction(lambda string, location, tokens: Literal(False))
+string = pyparsing.QuotedString('\'', escChar='\\', unquoteResults=False) | pyparsing.QuotedString('\"', escChar='\\', unquoteResults=False)
+string.setParseAction(lambda string, location, tokens: makeString(tokens[0]))
+expression = pyparsing.Forward()
+function_name = ~(pyparsing.Keyword('True') | pyparsing.Keyword('False') | pyparsing.Keyword('not') | pyparsing.Keyword('and') | pyparsing.Keyword('or')) + pyparsing.Word(pyparsing.alphas, pyparsing.alphanums + '_')
+function_call = function_name + pyparsing.Suppress('(') + pyparsing.Optional(pyparsing.delimitedList(expression)) + pyparsing.Suppress(')')
+function_call.setParseAction(lambda string, location, tokens: Call(tokens[0], tuple(tokens[1:])))
+parser = pyparsing.operatorPrecedence(function_call | variable_name | variable_name2 | double | integer | string | 
+                                true | false, [
+                                ('**', 2, pyparsing.opAssoc.RIGHT, makeBinaryChain),
+                                ('-', 1, pyparsing.opAssoc.RIGHT, makeUnary),
+                                (pyparsing.oneOf('* / // %'), 2, pyparsing.opAssoc.LEFT, makeBinaryChain),
+                                (pyparsing.oneOf('+ -'), 2, pyparsing.opAssoc.LEFT, makeBinaryChain),
+                                (pyparsing.oneOf('> >= < <= == !='), 2, pyparsing.opAssoc.LEFT, makeBinaryChain),
+                                ('not', 1, pyparsing.opAssoc.RIGHT, makeUnary),
+                                ('and', 2, pyparsing.opAssoc.LEFT, makeBinaryChain),
+                                ('or', 2, pyparsing.opAssoc.LEFT, makeBinaryChain)])
+expression <<= parser
+
+def splitArguments(text, separator):
+    # Split text on a separator, ignoring separators inside quoted
+    # strings and parentheses. Escaped characters are kept as they are.
+    parts = []
+    current = ''
+    quote = None
+    depth = 0
+    i = 0
+    while i < len(text):
+        char = text[i]
+        if quote:
+            if char == '\\' and i + 1 < len(text):
+                current += text[i:i+2]
+                i += 2
+                continue
+            if char == quote:
+                quote = None
+        elif char == '\'' or char == '\"':
+            quote = char
+        elif char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        elif depth == 0 and text.startswith(separator, i):
+            parts.append(current)
+            current = ''
+            i += len(separator)
+            continue
+        current += char
+        i += 1
+    parts.append(current)
+    return parts
+
+# Parsing dominates the cost of running loops and functions, the same
+# text is only parsed once.
+@functools.lru_cache(maxsize=4096)
 def parseExpression(text):
     # Parse things from the shell, these can be assignments to
     # variables, or conditions of if and while.
-    function = parser.parseString(text)[0]
-    if not isinstance(function, str) and not isinstance(function, int) and not isinstance(function, float):
-        function = function.asList()
+    with parse_lock:
+        function = parser.parseString(text)[0]
     logger.debug('Parsed function: {}', function)
     return function
 
-def evaluateExpression(ast, builtin_variables, variables):
-    def evaluateString(string):
-        if string[0] == '$':
-            if string[1] != '{':
-                if string[1:] in builtin_variables:
-                    value = builtin_variables[string[1:]]
-                elif string[1:] in variables:
-                    value = variables[string[1:]]
-                else:
-                    logger.error('Variable {} does not exist.', string[1:])
-                    raise NameError('Variable does not exist')
-            else:
-                if string[-1] != '}':
-                    logger.error('Unbalanced brackets {}.', string)
-                    raise NameError('Unbalanced brackets.')
-                if string[2:-1] in builtin_variables:
-                    value = builtin_variables[string[2:-1]]
-                elif string[2:-1] in variables:
-                    value = variables[string[2:-1]]
-                else:
-                    logger.error('Variable {} does not exist.', string[2:-1])
-                    raise NameError('Variable does not exist')
-        elif string == 'True':
-            value = True
-        elif string == 'False':
-            value = False
-        else:
-            if string[0] != string[-1] or (string[0] != '\'' and string[0] != '\"'):
-                logger.fatal('Impossible, should only handle quoted strings in this case. Recieved {}.', string)
-                exit(7)
-            value = string[1:-1]
-            # Tokenize any variables inside this string
-            variable = variable_name | variable_name2
-            spaces = pyparsing.White()
-            # Printables, minus $
-            non_variable = pyparsing.Word('0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ!"#%&\'()*+,-./:;<=>?@[\\]^_`{|}~')
-            grammar = pyparsing.ZeroOrMore(spaces | non_variable | variable)
-            values = grammar.parseString(value)
-            # Now evaluate the variables
-            newValue = ''
-            for i, value in enumerate(values):
-                if i == 0 and value[0] == '$':
-                    newValue += str(evaluateString(value))
-                elif value[0] == '$' and values[i-1][-1] != '\\':
-                    newValue += str(evaluateString(value))
-                else:
-                    newValue += value
-            value = newValue
-        return value
+def evaluateExpression(ast, builtin_variables, variables, functions=None):
     # Eval can be dangerous, so we do this by hand
-    if isinstance(ast, str):
-        # This should only happen on the top level
-        return evaluateString(ast)
-    if isinstance(ast, int) or isinstance(ast, float):
-        return ast
-
-    if not isinstance(ast, list):
-        logger.critical('Expecting AST as a list, got {} instead.', ast)
+    if not isinstance(ast, Node):
+        logger.critical('Expecting AST as a node, got {} instead.', ast)
         exit(5)
-
-    if len(ast) == 2:
-        value = evaluateExpression(ast[1], builtin_variables, variables)
-        value = unary_operators[ast[0]](value)
-        return value
-    elif ast[1] in right_binary_operators:
-        value = evaluateExpression(ast[-1], builtin_variables, variables)
-        for i in range(len(ast)-2, -1, -2):
-            tmp_value = evaluateExpression(ast[i-1], builtin_variables, variables)
-            value = right_binary_operators[ast[i]](tmp_value, value)
-        return value
-    elif ast[1] in left_binary_operators:
-        value = evaluateExpression(ast[0], builtin_variables, variables)
-        for i in range(1, len(ast), 2):
-            tmp_value = evaluateExpression(ast[i+1], builtin_variables, variables)
-            value = left_binary_operators[ast[i]](value, tmp_value)
-        return value
-    else:
-        logger.critical('AST includes an unknown binary operand {}.', key)
-        exit(6)
+    return ast.evaluate(builtin_variables, variables, functions)
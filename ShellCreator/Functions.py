@@ -0,0 +1,37 @@
+#!/usr/bin/python3
+
+class FunctionReturn(Exception):
+    # Raised by `return` to unwind to the function call
+    def __init__(self, value):
+        super().__init__()
+        self.value = value
+
+class Function:
+    # Every call nests a few python frames per block it runs, this keeps
+    # deep recursion well within python's own limit
+    max_depth = 50
+
+    def __init__(self, name, parameters, body):
+        self.name = name
+        self.parameters = parameters
+        # Already compiled statements, see Shell.compileBlock
+        self.body = body
+
+    def call(self, shell, values):
+        if len(values) != len(self.parameters):
+            shell.logger.error('Function {} takes {} arguments, got {}.', self.name, len(self.parameters), len(values))
+            raise NameError('Wrong number of arguments')
+        if len(shell.frames) >= self.max_depth:
+            shell.logger.error('Function {} exceeded the maximum call depth of {}.', self.name, self.max_depth)
+            raise NameError('Maximum call depth exceeded')
+        # Arguments live in a local frame that shadows the shell variables,
+        # everything set inside the function stays local to it
+        frame = dict(zip(self.parameters, values))
+        shell.pushFrame(frame)
+        try:
+            shell.runStatements(self.body)
+        except FunctionReturn as e:
+            return e.value
+        finally:
+            shell.popFrame()
+        return None
@@ -2,13 +2,16 @@
 
 from pygments.lexer import RegexLexer, include
 from pygments.token import *
+from pygments.token import _TokenType
+from prompt_toolkit.lexers import Lexer
+from prompt_toolkit.styles.pygments import pygments_token_to_classname
 
 class ShellLexer(RegexLexer):
     name = 'Shell'
     aliases = ['shell']
     filenames = ['*.shell']
 
-    commands = 'if|while|elif|else|end'
+    commands = 'if|while|for|in|elif|else|end|function|parallel'
 
     @classmethod
     def addCommand(cls, name):
@@ -54,3 +57,108 @@ class ShellLexer(RegexLexer):
                 (r'\bFalse\b', Number),
             ]
         }
+        # Pygments compiles the tokens once per class, drop them so new
+        # commands get highlighted too
+        if '_tokens' in cls.__dict__:
+            del cls._tokens
+
+class IncrementalShellLexer(Lexer):
+    # prompt_toolkit lexer that highlights the buffer one line at a time.
+    # Every line is cached with the ShellLexer state it starts in, so on a
+    # keystroke only lines whose text or starting state changed are lexed
+    # again, and only as far down as what is being displayed.
+
+    def __init__(self):
+        self.shell_lexer = None
+        self.tokendefs = None
+        self.cache = {}
+        self.styles = {}
+
+    def lexLine(self, text, stack):
+        # Same as RegexLexer.get_tokens_unprocessed, but for a single line
+        # and returning the state stack at its end
+        tokendefs = self.tokendefs
+        statestack = list(stack)
+        statetokens = tokendefs[statestack[-1]]
+        fragments = []
+        pos = 0
+        while pos < len(text):
+            for rexmatch, action, new_state in statetokens:
+                m = rexmatch(text, pos)
+                if m:
+                    if type(action) is _TokenType:
+                        fragments.append((action, m.group()))
+                    elif action is not None:
+                        fragments.extend((token, value) for _, token, value in action(self.shell_lexer, m))
+                    pos = m.end()
+                    if new_state is not None:
+                        if isinstance(new_state, tuple):
+                            for state in new_state:
+                                if state == '#pop':
+                                    if len(statestack) > 1:
+                                        statestack.pop()
+                                elif state == '#push':
+                                    statestack.append(statestack[-1])
+                                else:
+                                    statestack.append(state)
+                        elif isinstance(new_state, int):
+                            if abs(new_state) >= len(statestack):
+                                del statestack[1:]
+                            else:
+                                del statestack[new_state:]
+                        elif new_state == '#push':
+                            statestack.append(statestack[-1])
+                        statetokens = tokendefs[statestack[-1]]
+                    break
+            else:
+                if text[pos] == '\n':
+                    # At the end of the line, go back to root
+                    statestack = ['root']
+                    statetokens = tokendefs['root']
+                    pos += 1
+                    continue
+                fragments.append((Error, text[pos]))
+                pos += 1
+        return fragments, tuple(statestack)
+
+    def toStyle(self, token):
+        if token not in self.styles:
+            self.styles[token] = 'class:' + pygments_token_to_classname(token)
+        return self.styles[token]
+
+    def lex_document(self, document):
+        # Commands may have been added since the last call
+        self.shell_lexer = ShellLexer()
+        if self.shell_lexer._tokens is not self.tokendefs:
+            self.tokendefs = self.shell_lexer._tokens
+            self.cache = {}
+        lines = document.lines
+        old_cache = self.cache
+        cache = self.cache = {}
+        states = [('root',)]
+        formatted = []
+
+        def get_line(lineno):
+            if lineno < 0 or lineno >= len(lines):
+                return []
+            while len(formatted) <= lineno:
+                i = len(formatted)
+                key = (lines[i], states[i])
+                if key in cache:
+                    fragments, end = cache[key]
+                elif key in old_cache:
+                    fragments, end = cache[key] = old_cache[key]
+                else:
+                    # Lexed with its newline, as patterns may depend on it
+                    tokens, end = self.lexLine(lines[i] + '\n', states[i])
+                    fragments = []
+                    for token, value in tokens:
+                        value = value.rstrip('\n') if value.endswith('\n') else value
+                        if value:
+                            fragments.append((self.toStyle(token), value))
+                    cache[key] = (fragments, end)
+                states.append(end)
+                formatted.append(fragments)
+            return formatted[lineno]
+
+        return get_line
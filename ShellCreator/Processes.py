@@ -0,0 +1,76 @@
+#!/usr/bin/python3
+
+import os
+import queue
+import logging
+import subprocess
+import concurrent.futures
+
+logger = logging.getLogger('Shell')
+
+# Exit code used when a program cannot be started, same as most shells
+NOT_FOUND = 127
+
+class ProcessPool:
+    # Runs external programs on a shared pool of threads, so no more than
+    # max_workers programs run at the same time across the whole shell.
+    # Output is read line by line while the programs run.
+    def __init__(self, max_workers=None):
+        # Programs mostly wait on I/O, same default as ThreadPoolExecutor
+        self.max_workers = max_workers or min(32, (os.cpu_count() or 1) + 4)
+        self.executor = None
+        self.pid = None
+
+    def getExecutor(self):
+        # A fork only keeps the thread that forked, so a child, like a
+        # server session, needs threads of its own
+        if self.executor is None or self.pid != os.getpid():
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers)
+            self.pid = os.getpid()
+        return self.executor
+
+    def runProcess(self, argv, lines):
+        try:
+            # Programs may print anything, bytes that are not valid in the
+            # locale's encoding are replaced instead of failing
+            process = subprocess.Popen(argv, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True, errors='replace', bufsize=1)
+        except OSError as e:
+            logger.error('Could not run {}. Caused by:\n\t{}', argv[0], e)
+            return NOT_FOUND
+        try:
+            with process.stdout:
+                for line in process.stdout:
+                    lines.put(line.rstrip('\n'))
+        except BaseException:
+            process.kill()
+            raise
+        finally:
+            process.wait()
+        return process.returncode
+
+    def runWorker(self, argv, lines):
+        try:
+            return self.runProcess(argv, lines)
+        finally:
+            # Marks the end of this program's output
+            lines.put(None)
+
+    def run(self, commands, output=print, jobs=1):
+        # Run every command, at most jobs of them at a time, and return
+        # their exit codes in order. Lines are handed to output from the
+        # calling thread, whole lines of different programs may interleave.
+        lines = queue.Queue()
+        executor = self.getExecutor()
+        pending = list(reversed(commands))
+        running = 0
+        futures = []
+        while pending or running:
+            while pending and running < jobs:
+                futures.append(executor.submit(self.runWorker, pending.pop(), lines))
+                running += 1
+            line = lines.get()
+            if line is None:
+                running -= 1
+            else:
+                output(line)
+        return [future.result() for future in futures]
@@ -0,0 +1,190 @@
+#!/usr/bin/python3
+
+import io
+import os
+import sys
+import json
+import stat
+import errno
+import time
+import socket
+import struct
+import docopt
+import logging
+import traceback
+import socketserver
+from contextlib import redirect_stdout, redirect_stderr
+
+# Every message from the server is a frame: a type byte, the payload
+# length and the payload. Output frames carry utf-8 text, the exit frame
+# carries the exit status as a signed integer.
+STDOUT_FRAME = b'o'
+STDERR_FRAME = b'e'
+EXIT_FRAME = b'x'
+FRAME_HEADER = struct.Struct('!cI')
+EXIT_STATUS = struct.Struct('!i')
+
+logger = logging.getLogger('Shell')
+
+class FrameWriter(io.TextIOBase):
+    # File like object that forwards everything written to it as frames
+    def __init__(self, stream, frame_type):
+        self.stream = stream
+        self.frame_type = frame_type
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        if text:
+            data = text.encode('utf-8')
+            self.stream.write(FRAME_HEADER.pack(self.frame_type, len(data)) + data)
+            self.stream.flush()
+        return len(text)
+
+class ShellRequestHandler(socketserver.StreamRequestHandler):
+    # Runs inside a forked child, so whatever a session does to the shell
+    # is thrown away with the child
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            # Closed without a request, like another server checking
+            # whether this one is alive
+            return
+        shell = self.server.shell
+        stdout = FrameWriter(self.wfile, STDOUT_FRAME)
+        stderr = FrameWriter(self.wfile, STDERR_FRAME)
+        status = 0
+        with redirect_stdout(stdout), redirect_stderr(stderr):
+            # Log handlers keep the stream they were created with
+            for handler in logger.handlers:
+                if hasattr(handler, 'setStream'):
+                    handler.setStream(stderr)
+            try:
+                request = json.loads(line.decode('utf-8'))
+                if request.get('cwd'):
+                    os.chdir(request['cwd'])
+                if request.get('script'):
+                    shell.runScript(request['script'], shell_after=False)
+                for command in request.get('commands', []):
+                    shell.runCommand(command)
+            except SystemExit as e:
+                if e.code is None:
+                    status = 0
+                elif isinstance(e.code, int):
+                    status = e.code
+                else:
+                    status = 1
+            except Exception:
+                traceback.print_exc()
+                status = 1
+        self.wfile.write(FRAME_HEADER.pack(EXIT_FRAME, EXIT_STATUS.size) + EXIT_STATUS.pack(status))
+        self.wfile.flush()
+
+class ShellServer(socketserver.ForkingMixIn, socketserver.UnixStreamServer):
+    # How often to check for idle shutdown, in seconds
+    timeout = 1
+
+    def __init__(self, shell, path, max_sessions=8, idle_timeout=None):
+        self.shell = shell
+        self.path = path
+        self.max_children = max_sessions
+        self.idle_timeout = idle_timeout
+        self.last_activity = time.monotonic()
+        self.removeStaleSocket(path)
+        super().__init__(path, ShellRequestHandler)
+
+    def removeStaleSocket(self, path):
+        # Only a socket left over by a server that did not shut down
+        # cleanly is removed, anything else at path is left alone
+        try:
+            mode = os.stat(path).st_mode
+        except FileNotFoundError:
+            return
+        if not stat.S_ISSOCK(mode):
+            raise OSError(errno.EEXIST, '{} exists and is not a socket'.format(path))
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+            try:
+                probe.connect(path)
+            except ConnectionRefusedError:
+                os.unlink(path)
+                return
+        raise OSError(errno.EADDRINUSE, 'A server is already listening on {}'.format(path))
+
+    def process_request(self, request, client_address):
+        self.last_activity = time.monotonic()
+        super().process_request(request, client_address)
+
+    def isIdle(self):
+        if self.idle_timeout is None:
+            return False
+        if self.active_children:
+            # Idle time counts from when the last session ended
+            self.last_activity = time.monotonic()
+            return False
+        return time.monotonic() - self.last_activity > self.idle_timeout
+
+    def run(self):
+        try:
+            while not self.isIdle():
+                self.handle_request()
+                self.collect_children()
+            logger.info('Shell server idle for {} seconds, shutting down.', self.idle_timeout)
+        finally:
+            self.server_close()
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+
+class ShellClient:
+    def __init__(self, path):
+        self.path = path
+
+    def run(self, commands=None, script=None, stdout=None, stderr=None):
+        # Send commands and/or a script to the server, stream back its
+        # output and return the exit status
+        stdout = stdout or sys.stdout
+        stderr = stderr or sys.stderr
+        request = {
+            'commands': commands or [],
+            'script': os.path.abspath(script) if script else None,
+            'cwd': os.getcwd()
+        }
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+            connection.connect(self.path)
+            connection.sendall(json.dumps(request).encode('utf-8') + b'\n')
+            stream = connection.makefile('rb')
+            while True:
+                header = stream.read(FRAME_HEADER.size)
+                if len(header) < FRAME_HEADER.size:
+                    raise ConnectionError('Shell server closed the connection without an exit status')
+                frame_type, length = FRAME_HEADER.unpack(header)
+                payload = stream.read(length)
+                if frame_type == EXIT_FRAME:
+                    return EXIT_STATUS.unpack(payload)[0]
+                elif frame_type == STDOUT_FRAME:
+                    stdout.write(payload.decode('utf-8'))
+                    stdout.flush()
+                elif frame_type == STDERR_FRAME:
+                    stderr.write(payload.decode('utf-8'))
+                    stderr.flush()
+
+# Run as python3 -m ShellCreator.Server
+usage = '''
+shell-client
+
+Usage:
+    shell-client -h
+    shell-client SOCKET [-c COMMAND]... [SCRIPT]
+
+Options:
+    -h, --help                              Print this help message
+    -c COMMAND, --command=COMMAND           A command to run after the script
+'''
+
+def main():
+    args = docopt.docopt(usage)
+    client = ShellClient(args['SOCKET'])
+    return client.run(commands=args['--command'], script=args['SCRIPT'])
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,34 +1,67 @@
 #!/usr/bin/python3
 
+import os
+import re
+import sys
 import copy
+import collections
+import importlib.util
+import concurrent.futures
+import json
 import logging
 from prompt_toolkit import prompt
 from prompt_toolkit.styles import Style
 from prompt_toolkit.history import FileHistory
-from prompt_toolkit.lexers import PygmentsLexer
 
 from .Commands import *
 from .Completer import *
 from .Highlighter import *
-from .Expressions import parseExpression, evaluateExpression
+from .Expressions import parseExpression, evaluateExpression, splitArguments
 from .Indenter import bindings
+from .Functions import Function
+from .Processes import ProcessPool
+from .Compiler import ScriptCompiler
+from .Variables import VariableStore, VariableView, sizeOf
 from .Utils.ColoredLogs import ColorizedArgsFormatter
+from .Utils.VariableFiles import readers, valid_name
+from .Utils.ThreadOutput import ThreadOutput
+
+# Bump whenever the layout of saved snapshots changes
+STATE_VERSION = 2
+# The only types a snapshot may hold as values
+STATE_TYPES = (bool, int, float, str)
+# Words that open a block closed by `end`
+BLOCK_KEYWORDS = ['if', 'while', 'for', 'function', 'parallel']
 
 class Shell:
-    def __init__(self, prompt, style=None, history='.shell.history'):
+    def __init__(self, prompt, style=None, history='.shell.history', memory_budget=None, spill_path=None):
         self.prompt = prompt
         self.style = style
         self.history = history
         self.builtin_variables = {}
-        self.variables = {}
+        self.spill_path = spill_path
+        # The store costs a lock and size accounting on every access, only
+        # pay for it when there is a budget to keep
+        self.variables = {} if memory_budget is None else VariableStore(memory_budget, spill_path)
         self.commands = {}
+        self.functions = {}
+        self.frames = []
         self.completer = Completer()
+        self.lexer = IncrementalShellLexer()
+        self.processes = ProcessPool()
         self.addCommand('exit', Exit)
         self.addCommand('help', Help)
         self.addCommand('echo', Echo)
         self.addCommand('unset', Unset)
         self.addCommand('set', Set)
         self.addCommand('source', Source)
+        self.addCommand('save', Save)
+        self.addCommand('load', Load)
+        self.addCommand('return', Return)
+        self.addCommand('import', Import)
+        self.addCommand('run', Run)
+        self.addCommand('compile', Compile)
+        self.addBuiltinVariable('parallel_workers', self.processes.max_workers)
         self.inside_control = 0
         self.orig_prompt = []
         self.orig_style = []
@@ -67,7 +100,7 @@ class Shell:
             exit(8)
         self.commands[name] = cls(self)
         ShellLexer.addCommand(name)
-        self.completer.addCommand(name, cls)
+        self.completer.addCommand(name, self.commands[name])
 
     def addBuiltinVariable(self, name, value):
         if name in self.builtin_variables:
@@ -76,6 +109,162 @@ class Shell:
         self.builtin_variables[name] = value
         self.completer.addVariable(name)
 
+    def setMemoryBudget(self, budget):
+        # Bytes the values of variables may take in memory before the least
+        # recently used ones are spilled to disk, None for no limit
+        variables = self.globalVariables()
+        if isinstance(variables, VariableStore) and budget is not None:
+            variables.setBudget(budget)
+        elif isinstance(variables, VariableStore):
+            self.setGlobalVariables(dict(variables))
+            variables.clear()
+        elif budget is not None:
+            store = VariableStore(budget, self.spill_path)
+            store.update(variables)
+            self.setGlobalVariables(store)
+
+    def setGlobalVariables(self, variables):
+        # Function frames chain to the globals, point them to the new ones
+        if not self.frames:
+            self.variables = variables
+            return
+        self.frames[0] = variables
+        for chain in self.frames[1:] + [self.variables]:
+            chain.maps[-1] = variables
+
+    def memoryReport(self):
+        # Name, size and whether it is on disk for every variable, and the
+        # budget
+        variables = self.globalVariables()
+        if isinstance(variables, VariableStore):
+            return variables.report(), variables.budget
+        return [(name, sizeOf(value), False) for name, value in variables.items()], None
+
+    def globalVariables(self):
+        # The variable store, even from inside a function
+        return self.frames[0] if self.frames else self.variables
+
+    def dumpState(self):
+        # Serialize variables and the completion index to a snapshot. It is
+        # plain json, loading a snapshot can never run code.
+        state = {
+            'version': STATE_VERSION,
+            'builtin_variables': self.builtin_variables,
+            'variables': dict(self.globalVariables()),
+            'completer': self.completer.getVariables()
+        }
+        for name, value in list(state['builtin_variables'].items()) + list(state['variables'].items()):
+            if not isinstance(value, STATE_TYPES):
+                raise TypeError('Variable {} of type {} cannot be saved'.format(name, type(value).__name__))
+        return json.dumps(state, separators=(',', ':')).encode('utf-8')
+
+    def restoreState(self, data):
+        # Rehydrate everything in bulk, the completion index is taken from
+        # the snapshot as is instead of re-adding variables one by one
+        state = json.loads(data.decode('utf-8'))
+        if not isinstance(state, dict) or state.get('version') != STATE_VERSION:
+            raise ValueError('Unsupported snapshot version')
+        # Check everything before touching the shell, so a bad snapshot
+        # leaves it as it was
+        if not isinstance(state['builtin_variables'], dict) or not isinstance(state['variables'], dict):
+            raise ValueError('Corrupted snapshot, variables are not a dict')
+        for value in list(state['builtin_variables'].values()) + list(state['variables'].values()):
+            if not isinstance(value, STATE_TYPES):
+                raise ValueError('Corrupted snapshot, found a value of type {}'.format(type(value).__name__))
+        if not isinstance(state['completer'], list) or not all(isinstance(name, str) for name in state['completer']):
+            raise ValueError('Corrupted snapshot, completion index is not a list of names')
+        # Builtin variables registered after the snapshot was taken are kept
+        names = list(state['completer'])
+        names += [name for name in self.builtin_variables if name not in state['builtin_variables']]
+        self.builtin_variables.update(state['builtin_variables'])
+        variables = self.globalVariables()
+        variables.clear()
+        variables.update(state['variables'])
+        self.completer.setVariables(names)
+
+    def saveState(self, path):
+        try:
+            # Dumped first, so a failure does not truncate an old snapshot
+            data = self.dumpState()
+            with open(path, 'wb') as state_file:
+                state_file.write(data)
+        except (IOError, TypeError, ValueError) as e:
+            self.logger.error('Could not save snapshot. Caused by:\n\t{}', e)
+
+    def loadState(self, path):
+        try:
+            with open(path, 'rb') as state_file:
+                self.restoreState(state_file.read())
+        except (IOError, ValueError, KeyError, TypeError) as e:
+            self.logger.error('Could not load snapshot. Caused by:\n\t{}', e)
+
+    def loadVariables(self, path, file_format=None):
+        # Bulk import variables from a json, csv or KEY=VALUE file, the
+        # format is guessed from the extension unless given
+        if file_format is None:
+            file_format = os.path.splitext(path)[1][1:].lower()
+            if file_format not in readers:
+                file_format = 'env'
+        if file_format not in readers:
+            self.logger.error('Unknown variable file format {}, expected one of {}.', file_format, ', '.join(readers))
+            return
+        builtin_variables = {}
+        variables = {}
+        skipped = 0
+        try:
+            with open(path, 'r', newline='') as variable_file:
+                for name, value in readers[file_format](variable_file):
+                    if value is None or not valid_name.match(name):
+                        skipped += 1
+                    elif name in self.builtin_variables:
+                        builtin_variables[name] = value
+                    else:
+                        variables[name] = value
+        except (IOError, ValueError) as e:
+            self.logger.error('Could not import variables. Caused by:\n\t{}', e)
+            return
+        if skipped:
+            self.logger.warning('Skipped {} entries with invalid names or values.', skipped)
+        # Insert everything in one go
+        self.builtin_variables.update(builtin_variables)
+        if not self.frames and self.completer_built:
+            self.completer.addVariables([name for name in variables if name not in self.variables])
+        self.variables.update(variables)
+
+    def compileScript(self, script, output):
+        # Translate a script into a python module with a run(shell) function
+        try:
+            with open(script, 'r') as script_file:
+                lines = script_file.read().split('\n')
+            code = ScriptCompiler(self).compileScript(lines, os.path.basename(script))
+            with open(output, 'w') as output_file:
+                output_file.write(code)
+        except IOError as e:
+            self.logger.error('Could not compile script. Caused by:\n\t{}', e)
+
+    def runCompiled(self, path):
+        # Run a module created by compileScript, with this shell
+        spec = importlib.util.spec_from_file_location('compiled_script', path)
+        module = importlib.util.module_from_spec(spec)
+        try:
+            spec.loader.exec_module(module)
+        except IOError as e:
+            self.logger.error('Could not open compiled script. Caused by:\n\t{}', e)
+            return
+        module.run(self)
+
+    def serve(self, path, max_sessions=8, idle_timeout=None):
+        # Keep this shell warm behind a unix socket. Every session runs in
+        # a fork of it, so sessions never see each other's state. Imported
+        # here as only platforms with fork and unix sockets can serve.
+        from .Server import ShellServer
+        try:
+            server = ShellServer(self, path, max_sessions, idle_timeout)
+        except OSError as e:
+            self.logger.error('Could not start the shell server. Caused by:\n\t{}', e)
+            return
+        server.run()
+
     def runScript(self, script, shell_after=True):
         # If script specified, open its file
         if script is not None:
@@ -102,9 +291,347 @@ class Shell:
             else:
                 final_prompt.append((final_prompt[-1][0], ' '))
             # Start the prompt, add styles in the same manner as prompt_toolkit
-            user_command = prompt(final_prompt, style=self.style, history=FileHistory(self.history), lexer=PygmentsLexer(ShellLexer), key_bindings=bindings, completer=self.completer.getCompleter())
+            user_command = prompt(final_prompt, style=self.style, history=FileHistory(self.history), lexer=self.lexer, key_bindings=bindings, completer=self.completer.getCompleter(), complete_in_thread=True)
             self.runCommand(user_command)
 
+    @property
+    def completer(self):
+        # Parallel workers only build theirs if something needs it, from the
+        # variables they see at that point, so their variable changes need
+        # not be indexed until then
+        if not self.completer_built:
+            self._completer = Completer()
+            self._completer.setVariables(list(self.builtin_variables) + list(self.variables))
+        return self._completer
+
+    @completer.setter
+    def completer(self, completer):
+        self._completer = completer
+
+    @property
+    def completer_built(self):
+        return self._completer is not None
+
+    def setVariable(self, name, value):
+        if name in self.builtin_variables:
+            self.builtin_variables[name] = value
+        else:
+            # Function locals are not offered for autocompletion
+            if name not in self.variables and not self.frames and self.completer_built:
+                self.completer.addVariable(name)
+            self.variables[name] = value
+
+    def unsetVariable(self, name):
+        if self.frames:
+            if name not in self.variables.maps[0]:
+                self.logger.error('Cannot unset variable {} from outside of its function.', name)
+                return
+            del self.variables[name]
+        else:
+            del self.variables[name]
+            if self.completer_built:
+                self.completer.deleteVariable(name)
+
+    def pushFrame(self, frame):
+        # Frames only shadow the global variables, not the caller's locals
+        self.frames.append(self.variables)
+        self.variables = collections.ChainMap(frame, self.frames[0])
+
+    def popFrame(self):
+        self.variables = self.frames.pop()
+
+    def defineFunction(self, header, commands):
+        names = header.split()
+        if not names or any(re.match(r'^[a-zA-Z]\w*$', name) is None for name in names):
+            self.logger.error('Invalid function definition {}, expected `function NAME ARGS`.', header)
+            return
+        name = names[0]
+        if name in self.commands or name in BLOCK_KEYWORDS:
+            self.logger.error('Function {} clashes with an existing command.', name)
+            return
+        if name not in self.functions:
+            ShellLexer.addCommand(name)
+            self.completer.addFunction(name)
+        # The body is compiled once here, calls only run it
+        self.functions[name] = Function(name, names[1:], self.compileBlock(commands))
+
+    def callFunction(self, name, values):
+        if name not in self.functions:
+            self.logger.error('Function {} does not exist.', name)
+            raise NameError('Function does not exist')
+        return self.functions[name].call(self, values)
+
+    def evaluateArguments(self, text):
+        # Evaluate a comma separated list of expressions
+        if text.strip() == '':
+            return []
+        values = []
+        for argument in splitArguments(text, ','):
+            values.append(evaluateExpression(parseExpression(argument), self.builtin_variables, self.variables, self.callFunction))
+        return values
+
+    def compileBlock(self, lines):
+        # Group lines into statements ahead of time. Commands stay as
+        # strings, blocks become (type, conditions, commands) tuples whose
+        # bodies are compiled the same way, so running them skips the
+        # line by line collection done in runCommand.
+        statements = []
+        stack = []
+        for line in lines:
+            if not isinstance(line, str):
+                # Already compiled
+                (stack[-1][2][-1] if stack else statements).append(line)
+                continue
+            line = line.strip()
+            if line == '' or line[0] == '#':
+                continue
+            split = line.split(' ', 1)
+            command = split[0]
+            header = split[1] if len(split) == 2 else ''
+            if command in BLOCK_KEYWORDS:
+                stack.append((command, [header], [[]]))
+            elif command == 'elif' and stack and stack[-1][0] == 'if':
+                stack[-1][1].append(header)
+                stack[-1][2].append([])
+            elif command == 'else' and stack and stack[-1][0] == 'if':
+                stack[-1][1].append(None)
+                stack[-1][2].append([])
+            elif line.replace(' ', '') == 'end' and stack:
+                block = stack.pop()
+                (stack[-1][2][-1] if stack else statements).append(block)
+            else:
+                (stack[-1][2][-1] if stack else statements).append(line)
+        if stack:
+            self.logger.error('Block {} is missing its end.', stack[0][0])
+        return statements
+
+    def runStatements(self, statements):
+        for statement in statements:
+            if isinstance(statement, str):
+                self.runCommand(statement)
+            else:
+                self.runControl(*statement)
+
+    def runControl(self, control_type, conditions, commands):
+        if control_type == 'if':
+            self.runIf(conditions, commands)
+        elif control_type == 'while':
+            self.runWhile(conditions, commands)
+        elif control_type == 'for':
+            self.runFor(conditions, commands)
+        elif control_type == 'function':
+            self.defineFunction(conditions[0], commands[0])
+        elif control_type == 'parallel':
+            self.runParallel(conditions, commands)
+        else:
+            self.logger.fatal('Recieved end for something other than if, while, for, function and parallel {}.', control_type)
+            exit(9)
+
+    def runIf(self, conditions, commands):
+        # Check all conditions to find the correct one
+        for i, if_condition in enumerate(conditions):
+            try:
+                if i == len(conditions) - 1 and if_condition == None:
+                    # If this is an else, and nothing before it is taken
+                    value = True
+                else:
+                    ast = parseExpression(if_condition)
+                    value = evaluateExpression(ast, self.builtin_variables, self.variables, self.callFunction)
+            except NameError as e:
+                break
+            except pyparsing.ParseException as e:
+                self.logger.error('Couldn\'t parse condition {}.', if_condition)
+                break
+            if value:
+                # Run the commands in those condition
+                self.runStatements(commands[i])
+                break
+
+    def runWhile(self, conditions, commands):
+        # Make sure we have only one condition
+        if len(conditions) != 1 or len(commands) != 1:
+            self.logger.fatal('Found while loop with more than one condition: {}, {}.', conditions, commands)
+            exit(10)
+        while True:
+            try:
+                ast = parseExpression(conditions[0])
+                value = evaluateExpression(ast, self.builtin_variables, self.variables, self.callFunction)
+            except NameError as e:
+                break
+            except pyparsing.ParseException as e:
+                self.logger.error('Couldn\'t parse condition {}.', conditions[0])
+                break
+            if value:
+                # Run the commands in those condition
+                self.runStatements(commands[0])
+            else:
+                break
+
+    def iterateFor(self, header):
+        # Turns `NAME in START..STOP[..STEP]` or `NAME in EXPR, EXPR, ...`
+        # into the loop variable name and a python iterable of its values
+        match = re.match(r'^([a-zA-Z]\w*)\s+in\s+(.+)$', header.strip())
+        if match is None:
+            self.logger.error('Invalid for loop {}, expected `for NAME in RANGE_OR_LIST`.', header)
+            raise ValueError('Invalid for loop')
+        name, iterable = match.groups()
+        bounds = splitArguments(iterable, '..')
+        if len(bounds) > 1:
+            if len(bounds) > 3:
+                self.logger.error('Invalid range {}, expected START..STOP[..STEP].', iterable)
+                raise ValueError('Invalid range')
+            values = []
+            for bound in bounds:
+                value = evaluateExpression(parseExpression(bound), self.builtin_variables, self.variables, self.callFunction)
+                if not isinstance(value, int) or isinstance(value, bool):
+                    self.logger.error('Range bounds must be integers, got {}.', value)
+                    raise ValueError('Invalid range')
+                values.append(value)
+            if len(values) == 3 and values[2] == 0:
+                self.logger.error('Range step cannot be zero.')
+                raise ValueError('Invalid range')
+            return name, range(*values)
+        return name, self.evaluateArguments(iterable)
+
+    def loopValues(self, header):
+        # Same as iterateFor, but errors are logged and give an empty loop
+        try:
+            return self.iterateFor(header)
+        except (NameError, ValueError) as e:
+            return None, []
+        except pyparsing.ParseException as e:
+            self.logger.error('Couldn\'t parse for loop {}.', header)
+            return None, []
+
+    def runFor(self, conditions, commands):
+        # Make sure we have only one header
+        if len(conditions) != 1 or len(commands) != 1:
+            self.logger.fatal('Found for loop with more than one header: {}, {}.', conditions, commands)
+            exit(10)
+        name, values = self.loopValues(conditions[0])
+        for value in values:
+            # Bind the loop variable directly, no need to go through `set`
+            self.setVariable(name, value)
+            self.runStatements(commands[0])
+
+    def spawnWorker(self):
+        # A copy of this shell to run part of a parallel block on another
+        # thread. It gets its own copy of the variables, its own control
+        # state and its own command instances, as commands keep their args.
+        worker = copy.copy(self)
+        # Variables are read from this shell as needed instead of copied,
+        # writes are kept by the worker with the same budget
+        worker.variables = VariableView(self.variables, getattr(self.globalVariables(), 'budget', None))
+        worker.builtin_variables = dict(self.builtin_variables)
+        worker.frames = []
+        worker.completer = None
+        worker.commands = {}
+        for name, command in self.commands.items():
+            worker.commands[name] = type(command)(worker)
+        worker.inside_control = 0
+        worker.orig_prompt = []
+        worker.orig_style = []
+        worker.conditions = []
+        worker.condition_types = []
+        worker.condition_commands = []
+        return worker
+
+    def runTask(self, setup, statements):
+        # Runs on a pool thread, with its prints and logs going to its own
+        # buffer
+        worker = self.spawnWorker()
+        buffer = []
+        ThreadOutput.setBuffer(buffer)
+        try:
+            if setup is not None:
+                worker.setVariable(*setup)
+            worker.runStatements(statements)
+        finally:
+            ThreadOutput.setBuffer(None)
+        return worker, buffer
+
+    def mergeWorker(self, worker, builtin_variables):
+        # Apply whatever the worker changed
+        for name, value in worker.builtin_variables.items():
+            if builtin_variables.get(name) is not value:
+                self.builtin_variables[name] = value
+        # Only what the worker wrote is read, untouched values stay where
+        # they are, in memory or on disk
+        view = worker.variables
+        for name in view.written:
+            self.setVariable(name, view.written[name])
+        for name in view.deleted:
+            if name in self.variables:
+                self.unsetVariable(name)
+
+    def runParallel(self, conditions, commands):
+        # Make sure we have only one header
+        if len(conditions) != 1 or len(commands) != 1:
+            self.logger.fatal('Found parallel block with more than one header: {}, {}.', conditions, commands)
+            exit(10)
+        workers = self.builtin_variables['parallel_workers']
+        if not isinstance(workers, int) or isinstance(workers, bool) or workers < 1:
+            self.logger.error('parallel_workers must be a positive integer, got {}.', workers)
+            return
+        statements = self.compileBlock(commands[0])
+        header = conditions[0].strip()
+        if header == '':
+            # Every statement in the block is a task of its own
+            tasks = [(None, [statement]) for statement in statements]
+        elif header.split(' ', 1)[0] == 'for':
+            # Every iteration is a task
+            name, values = self.loopValues(header.split(' ', 1)[1] if ' ' in header else '')
+            tasks = [((name, value), statements) for value in values]
+        else:
+            self.logger.error('Invalid parallel block {}, expected `parallel` or `parallel for`.', header)
+            return
+        builtin_variables = dict(self.builtin_variables)
+        # Prints and logs of the tasks are buffered per task. Nested parallel
+        # blocks reuse the outputs already in place.
+        original = sys.stdout
+        if not isinstance(sys.stdout, ThreadOutput):
+            sys.stdout = ThreadOutput(sys.stdout)
+        handlers = {}
+        for handler in logging.getLogger('Shell').handlers:
+            if isinstance(handler, logging.StreamHandler) and not isinstance(handler.stream, ThreadOutput):
+                handlers[handler] = handler.setStream(ThreadOutput(handler.stream))
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = [executor.submit(self.runTask, setup, body) for setup, body in tasks]
+                results = [future.result() for future in futures]
+        finally:
+            sys.stdout = original
+            for handler, stream in handlers.items():
+                handler.setStream(stream)
+        # Replay and merge in task order, so the result does not depend on
+        # timing
+        for worker, buffer in results:
+            for output, text in buffer:
+                output.write(text)
+            self.mergeWorker(worker, builtin_variables)
+
+    def runPipeline(self, stages):
+        # Chain the stages as generators, each one pulls records from the
+        # previous one when it needs them, so nothing is held in memory and
+        # a stage never runs ahead of the one consuming it
+        records = None
+        for stage in stages:
+            user_command = stage.strip().split(' ', 1)
+            command = user_command[0]
+            if command not in self.commands:
+                self.logger.error('Unknown command {}, run `help` to find all supported commands.', command)
+                return
+            if not self.commands[command].streaming:
+                self.logger.error('Command {} cannot be used in a pipeline.', command)
+                return
+            # A new instance per stage, the same command may appear twice
+            # and its arguments are read lazily
+            instance = type(self.commands[command])(self)
+            instance.getArgs(user_command[1] if len(user_command) == 2 else '')
+            records = instance.pipe(records)
+        for record in records:
+            print(record)
+
     def runCommand(self, entire_command):
         # Ignore empty lines and comments
         if entire_command == '' or entire_command[0] == '#':
@@ -113,8 +640,10 @@ class Shell:
         # Find the called command first
         user_command = entire_command.split(' ', 1)
         command = user_command[0]
-        if command == 'if' or command == 'while':
-            # If the command is an if or a while, handle it
+        # Split pipelines, a | inside a string does not count
+        stages = splitArguments(entire_command, '|') if '|' in entire_command else [entire_command]
+        if command in BLOCK_KEYWORDS:
+            # If the command is an if, a while, a for or a function, handle it
             self.inside_control += 1
             self.logger.debug('{} level: {}', command, self.inside_control)
             if self.inside_control == 1:
@@ -134,7 +663,7 @@ class Shell:
                 # while the second is a list of lists containing 
                 # the commands inside each if
                 self.condition_types.append(command)
-                self.conditions.append([user_command[1]])
+                self.conditions.append([user_command[1] if len(user_command) == 2 else ''])
                 self.condition_commands.append([[]])
             else:
                 # Or it is a control inside control, save, don't run
@@ -165,78 +694,43 @@ class Shell:
             self.logger.debug('{} level: {}', 'end', self.inside_control)
             self.inside_control -= 1
             if not self.inside_control:
-                if self.condition_types[-1] == 'if':
-                    # Check all conditions to find the correct one
-                    index = len(self.conditions) - 1
-                    for i, if_condition in enumerate(self.conditions[index]):
-                        try:
-                            if i == len(self.conditions[index]) - 1 and self.conditions[index][i] == None:
-                                # If this is an else, and nothing before it is taken
-                                value = True
-                            else:
-                                ast = parseExpression(if_condition)
-                                value = evaluateExpression(ast, self.builtin_variables, self.variables)
-                        except NameError as e:
-                            break
-                        except pyparsing.ParseException as e:
-                            logger.error('Couldn\'t parse condition {}.', if_condition)
-                            break
-                        if value:
-                            # Run the commands in those condition
-                            for command in self.condition_commands[index][i]:
-                                self.runCommand(command)
-                            break
-                elif self.condition_types[-1] == 'while':
-                    # Make sure we have only one condition
-                    if len(self.conditions[-1]) != 1 or len(self.condition_commands[-1]) != 1:
-                        self.logger.fatal('Found while loop with more than one condition: {}, {}.', self.conditions[-1], self.condition_commands[-1])
-                        exit(10)
-                    # Check all conditions to find the correct one
-                    index = len(self.conditions) - 1
-                    while True:
-                        try:
-                            ast = parseExpression(self.conditions[index][0])
-                            value = evaluateExpression(ast, self.builtin_variables, self.variables)
-                        except NameError as e:
-                            break
-                        except pyparsing.ParseException as e:
-                            logger.error('Couldn\'t parse condition {}.', self.conditions[index][0])
-                            break
-                        if value:
-                            # Run the commands in those condition
-                            for command in self.condition_commands[index][0]:
-                                self.runCommand(command)
-                        else:
-                            break
-                else:
-                    self.logger.fatal('Recieved end for something other than if and while {}.', self.condition_types[-1])
-                    exit(9)
+                # Take the block off the stacks before running it, so that
+                # blocks nested inside it can reuse them
+                control_type = self.condition_types.pop()
+                conditions = self.conditions.pop()
+                commands = self.condition_commands.pop()
                 # Return prompt to normal
-                self.prompt = self.orig_prompt[-1]
-                self.style = self.orig_style[-1]
-                del self.orig_prompt[-1]
-                del self.orig_style[-1]
-                del self.conditions[-1]
-                del self.condition_types[-1]
-                del self.condition_commands[-1]
+                self.prompt = self.orig_prompt.pop()
+                self.style = self.orig_style.pop()
+                self.runControl(control_type, conditions, commands)
             else:
                 # Or it is an end inside control, save, don't run
                 self.condition_commands[-1][-1].append(entire_command)
+        elif self.inside_control:
+            # Or it is a command inside a control, save, don't run. It is
+            # only looked up when it runs, as it may be a function defined later
+            self.condition_commands[-1][-1].append(entire_command)
+        elif len(stages) > 1:
+            self.runPipeline(stages)
         elif command in self.commands:
-            if self.inside_control:
-                # Or it is a command inside if, save, don't run
-                self.condition_commands[-1][-1].append(entire_command)
+            # Otherwise it is a normal command
+            # Run the command
+            if len(user_command) == 2:
+                self.commands[command].getArgs(user_command[1])
+            elif len(user_command) == 1:
+                self.commands[command].getArgs('')
             else:
-                # Otherwise it is a normal command
-                # Run the command
-                if len(user_command) == 2:
-                    self.commands[command].getArgs(user_command[1])
-                elif len(user_command) == 1:
-                    self.commands[command].getArgs('')
-                else:
-                    self.logger.critical('Failed to split command correctly')
-                    exit(2)
-                self.commands[command].action()
+                self.logger.critical('Failed to split command correctly')
+                exit(2)
+            self.commands[command].action()
+        elif command in self.functions:
+            # A function called as a command, its return value is dropped
+            try:
+                self.callFunction(command, self.evaluateArguments(user_command[1] if len(user_command) == 2 else ''))
+            except NameError as e:
+                pass
+            except pyparsing.ParseException as e:
+                self.logger.error('Couldn\'t parse arguments of {}.', command)
         else:
             self.logger.error('Unknown command {}, run `help` to find all supported commands.', command)
         return
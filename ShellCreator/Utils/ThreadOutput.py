@@ -0,0 +1,35 @@
+#!/usr/bin/python3
+
+import io
+import threading
+
+# Shared by every ThreadOutput, so a thread's prints and logs end up in the
+# same buffer in the order they were written
+local = threading.local()
+
+class ThreadOutput(io.TextIOBase):
+    # Stands in for a stream, like sys.stdout or the stream of a log
+    # handler, while threads run. Threads that registered a buffer append
+    # (output, text) to it, to be replayed with output.write(text) later.
+    # Everything else goes to the original stream.
+    def __init__(self, stream):
+        self.stream = stream
+
+    def writable(self):
+        return True
+
+    @staticmethod
+    def setBuffer(buffer):
+        local.buffer = buffer
+
+    def write(self, text):
+        buffer = getattr(local, 'buffer', None)
+        if buffer is not None:
+            buffer.append((self, text))
+            return len(text)
+        return self.stream.write(text)
+
+    def flush(self):
+        buffer = getattr(local, 'buffer', None)
+        if buffer is None:
+            self.stream.flush()
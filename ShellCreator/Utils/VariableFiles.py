@@ -0,0 +1,73 @@
+#!/usr/bin/python3
+
+import re
+import csv
+import json
+
+# Same names the expression parser accepts
+valid_name = re.compile(r'^[a-zA-Z][a-zA-Z0-9_]*$')
+integer = re.compile(r'^[+-]?\d+$')
+real = re.compile(r'^[+-]?(\d+\.\d*|\.\d+|\d+)([eE][+-]?\d+)?$')
+
+def convertValue(text):
+    # Turn text from a csv or env file into the shell's types
+    text = text.strip()
+    if len(text) >= 2 and text[0] == text[-1] and text[0] in '\'"':
+        return text[1:-1]
+    if text.lower() == 'true':
+        return True
+    if text.lower() == 'false':
+        return False
+    if integer.match(text):
+        return int(text)
+    if real.match(text):
+        return float(text)
+    return text
+
+def readJSON(stream):
+    # The file must hold one object, nested objects are flattened by
+    # joining their keys with _. Lists and nulls have no shell type.
+    data = json.load(stream)
+    if not isinstance(data, dict):
+        raise ValueError('Expected a JSON object')
+    stack = [('', data)]
+    while stack:
+        prefix, obj = stack.pop()
+        for key, value in obj.items():
+            name = prefix + key
+            if isinstance(value, dict):
+                stack.append((name + '_', value))
+            elif isinstance(value, (bool, int, float, str)):
+                yield name, value
+            else:
+                yield name, None
+
+def readCSV(stream):
+    # Rows of name,value, a name,value header is skipped
+    for i, row in enumerate(csv.reader(stream)):
+        if not row:
+            continue
+        if i == 0 and [cell.strip().lower() for cell in row] == ['name', 'value']:
+            continue
+        if len(row) != 2:
+            raise ValueError('Expected two columns on line {}'.format(i + 1))
+        yield row[0].strip(), convertValue(row[1])
+
+def readEnv(stream):
+    # KEY=VALUE lines, with comments and an optional export
+    for i, line in enumerate(stream):
+        line = line.strip()
+        if not line or line[0] == '#':
+            continue
+        if line.startswith('export '):
+            line = line[len('export '):]
+        name, separator, value = line.partition('=')
+        if not separator:
+            raise ValueError('Expected KEY=VALUE on line {}'.format(i + 1))
+        yield name.strip(), convertValue(value)
+
+readers = {
+    'json': readJSON,
+    'csv': readCSV,
+    'env': readEnv,
+}
@@ -0,0 +1,195 @@
+#!/usr/bin/python3
+
+import os
+import sys
+import pickle
+import sqlite3
+import threading
+import collections
+import collections.abc
+
+def sizeOf(value):
+    # Memory taken by a value, the shell only has flat types
+    return sys.getsizeof(value)
+
+def formatSize(size):
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if size < 1024 or unit == 'GB':
+            break
+        size /= 1024
+    return '{:.0f} {}'.format(size, unit) if unit == 'B' else '{:.1f} {}'.format(size, unit)
+
+class VariableStore(collections.abc.MutableMapping):
+    # Holds the global variables of a shell that has a memory budget, the
+    # least recently used values are spilled to an sqlite file once the
+    # values in memory take more than budget bytes, and paged back in when
+    # read. Values larger than the budget stay on disk and are read from
+    # there every time. Shells without a budget use a plain dict.
+    def __init__(self, budget=None, path=None):
+        self.budget = budget
+        self.path = path
+        # Every name, in the order they were set
+        self.names = {}
+        self.sizes = {}
+        # Values in memory, least recently used first
+        self.values = collections.OrderedDict()
+        self.memory = 0
+        self.spilled = set()
+        self.connection = None
+        self.pid = os.getpid()
+        self.lock = threading.RLock()
+
+    def getConnection(self):
+        if self.connection is not None and self.pid != os.getpid():
+            # sqlite connections cannot be shared with a fork, the child
+            # copies what was spilled to a file of its own
+            old = self.connection
+            self.connection = self.openConnection('')
+            rows = old.execute('SELECT name, value FROM variables').fetchall()
+            self.connection.executemany('INSERT INTO variables VALUES (?, ?)', rows)
+            old.close()
+            self.pid = os.getpid()
+        if self.connection is None:
+            self.connection = self.openConnection(self.path or '')
+        return self.connection
+
+    def openConnection(self, path):
+        # An empty path is a temporary file deleted once closed
+        connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        connection.execute('DROP TABLE IF EXISTS variables')
+        connection.execute('CREATE TABLE variables (name TEXT PRIMARY KEY, value BLOB)')
+        return connection
+
+    def setBudget(self, budget):
+        with self.lock:
+            self.budget = budget
+            self.evict()
+
+    def spill(self, name, value):
+        data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        self.getConnection().execute('INSERT OR REPLACE INTO variables VALUES (?, ?)', (name, data))
+        self.spilled.add(name)
+
+    def read(self, name):
+        row = self.getConnection().execute('SELECT value FROM variables WHERE name = ?', (name,)).fetchone()
+        return pickle.loads(row[0])
+
+    def evict(self):
+        # Spill cold values until the ones in memory fit the budget
+        if self.budget is None:
+            return
+        while self.memory > self.budget and self.values:
+            name, value = self.values.popitem(last=False)
+            self.memory -= self.sizes[name]
+            self.spill(name, value)
+
+    def discard(self, name):
+        if name in self.values:
+            del self.values[name]
+            self.memory -= self.sizes[name]
+        elif name in self.spilled:
+            self.spilled.remove(name)
+            self.getConnection().execute('DELETE FROM variables WHERE name = ?', (name,))
+
+    def store(self, name, value):
+        size = self.sizes[name]
+        if self.budget is not None and size > self.budget:
+            self.spill(name, value)
+            return
+        self.values[name] = value
+        self.memory += size
+        self.evict()
+
+    def __getitem__(self, name):
+        with self.lock:
+            if name in self.values:
+                self.values.move_to_end(name)
+                return self.values[name]
+            if name not in self.spilled:
+                raise KeyError(name)
+            value = self.read(name)
+            if self.budget is None or self.sizes[name] <= self.budget:
+                # Page it back in, which may spill others
+                self.discard(name)
+                self.store(name, value)
+            return value
+
+    def __setitem__(self, name, value):
+        with self.lock:
+            self.discard(name)
+            self.names[name] = None
+            self.sizes[name] = sizeOf(value)
+            self.store(name, value)
+
+    def __delitem__(self, name):
+        with self.lock:
+            if name not in self.names:
+                raise KeyError(name)
+            self.discard(name)
+            del self.names[name]
+            del self.sizes[name]
+
+    def clear(self):
+        with self.lock:
+            self.names.clear()
+            self.sizes.clear()
+            self.values.clear()
+            self.memory = 0
+            if self.spilled:
+                self.getConnection().execute('DELETE FROM variables')
+                self.spilled.clear()
+
+    def __contains__(self, name):
+        return name in self.names
+
+    def __iter__(self):
+        return iter(list(self.names))
+
+    def __len__(self):
+        return len(self.names)
+
+    def report(self):
+        # Name, size and whether it is on disk, for every variable
+        with self.lock:
+            return [(name, self.sizes[name], name in self.spilled) for name in self.names]
+
+class VariableView(collections.abc.MutableMapping):
+    # What a parallel task sees of the shell's variables. Reads go to the
+    # shell's variables, which do not change while the tasks run, writes
+    # and deletions are kept aside to be merged once the task is done.
+    def __init__(self, base, budget=None):
+        self.base = base
+        # Written values get the same budget as the shell
+        self.written = {} if budget is None else VariableStore(budget)
+        self.deleted = set()
+
+    def __getitem__(self, name):
+        if name in self.written:
+            return self.written[name]
+        if name in self.deleted:
+            raise KeyError(name)
+        return self.base[name]
+
+    def __setitem__(self, name, value):
+        self.deleted.discard(name)
+        self.written[name] = value
+
+    def __delitem__(self, name):
+        if name not in self:
+            raise KeyError(name)
+        if name in self.written:
+            del self.written[name]
+        if name in self.base:
+            self.deleted.add(name)
+
+    def __contains__(self, name):
+        return name in self.written or (name not in self.deleted and name in self.base)
+
+    def __iter__(self):
+        for name in self.base:
+            if name not in self.deleted and name not in self.written:
+                yield name
+        yield from self.written
+
+    def __len__(self):
+        return sum(1 for name in self)
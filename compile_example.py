@@ -0,0 +1,48 @@
+#!/usr/bin/python3
+
+import io
+import os
+import sys
+import tempfile
+from contextlib import redirect_stdout
+from ShellCreator.Shell import Shell
+
+# Scripts given as arguments, or the example script
+scripts = sys.argv[1:] or ['script.shell']
+
+def interpret(script):
+    shell = Shell('Interpreter>>')
+    shell.createLogging()
+    output = io.StringIO()
+    with redirect_stdout(output):
+        try:
+            shell.runScript(script, shell_after=False)
+        except SystemExit:
+            pass
+    return output.getvalue(), shell.variables
+
+def compiled(script, directory):
+    shell = Shell('Compiled>>')
+    shell.createLogging()
+    module = os.path.join(directory, os.path.basename(script) + '.py')
+    shell.compileScript(script, module)
+    output = io.StringIO()
+    with redirect_stdout(output):
+        try:
+            shell.runCompiled(module)
+        except SystemExit:
+            pass
+    return output.getvalue(), shell.variables
+
+# Both must print the same and end with the same variables
+failed = False
+directory = tempfile.mkdtemp()
+for script in scripts:
+    expected = interpret(script)
+    result = compiled(script, directory)
+    if expected != result:
+        failed = True
+        print('{} differs when compiled:\n{}\n{}'.format(script, expected, result))
+    else:
+        print('{} compiled'.format(script))
+exit(1 if failed else 0)
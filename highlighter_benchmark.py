@@ -0,0 +1,48 @@
+#!/usr/bin/python3
+
+import time
+from ShellCreator.Shell import Shell
+from ShellCreator.Highlighter import ShellLexer, IncrementalShellLexer
+from prompt_toolkit.document import Document
+from prompt_toolkit.lexers import PygmentsLexer
+
+# Registers the builtin commands with the lexer
+shell = Shell('Benchmark>>')
+
+# A 10k lines buffer, as if a long script was pasted into the prompt
+block = [
+    'set total=0',
+    'for i in 0..100',
+    '    if $i % 2 == 0',
+    '        set total=$total + $i * 2',
+    '    else',
+    '        echo "odd $i, total is ${total}"',
+    '    end',
+    'end',
+    '# Done with this block',
+    'echo $total',
+]
+lines = block * 1000
+keystrokes = 20
+# Lines shown on screen around the cursor
+window = 40
+
+def benchmark(name, lexer):
+    # Type characters in the middle of the buffer, and render the lines
+    # around the cursor after every keystroke like the prompt would
+    buffer = list(lines)
+    row = len(buffer) // 2
+    get_line = lexer.lex_document(Document('\n'.join(buffer)))
+    for lineno in range(row - window // 2, row + window // 2):
+        get_line(lineno)
+    start = time.perf_counter()
+    for i in range(keystrokes):
+        buffer[row] += 'x'
+        get_line = lexer.lex_document(Document('\n'.join(buffer)))
+        for lineno in range(row - window // 2, row + window // 2):
+            get_line(lineno)
+    elapsed = (time.perf_counter() - start) / keystrokes
+    print('{}: {:.2f} ms per keystroke'.format(name, elapsed * 1000))
+
+benchmark('PygmentsLexer', PygmentsLexer(ShellLexer))
+benchmark('IncrementalShellLexer', IncrementalShellLexer())